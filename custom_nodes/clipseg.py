@@ -1,65 +1,292 @@
-from transformers import CLIPSegProcessor, CLIPSegForImageSegmentation
-
-from PIL import Image
 import torch
-import torchvision.transforms as T
+import torch.nn.functional as F
 import numpy as np
 
-from torchvision.transforms.functional import to_pil_image
-import matplotlib.pyplot as plt
-import matplotlib.cm as cm
-
 
 import cv2
 
-from scipy.ndimage import gaussian_filter
+import importlib.util
+import math
+from functools import lru_cache
+
+from typing import TYPE_CHECKING, Callable, List, Optional, Tuple
 
-from typing import Optional, Tuple
+import comfy.model_management as model_management
 
 import warnings
-warnings.filterwarnings("ignore", category=UserWarning, module="torch")
-warnings.filterwarnings("ignore", category=UserWarning, module="safetensors")
+
+# transformers is slow to import, so it is only imported when the model is first loaded
+if TYPE_CHECKING:
+    from transformers import CLIPSegProcessor, CLIPSegForImageSegmentation
 
 
 
 """Helper methods for CLIPSeg nodes"""
 
+CLIPSEG_MODEL = "CIDAS/clipseg-rd64-refined"
+
+# 256-entry RGB lookup tables for the colormaps used by the heatmap and binary mask overlays,
+# precomputed from matplotlib's viridis and Greys_r so matplotlib is not needed at runtime.
+# Each table is followed by matplotlib's "bad" color (black) at _BAD_INDEX, used for invalid (NaN) values.
+_BAD_INDEX = 256
+_VIRIDIS_LUT = np.array([
+    [68, 1, 84], [68, 2, 85], [68, 3, 87], [69, 5, 88], [69, 6, 90], [69, 8, 91],
+    [70, 9, 92], [70, 11, 94], [70, 12, 95], [70, 14, 97], [71, 15, 98], [71, 17, 99],
+    [71, 18, 101], [71, 20, 102], [71, 21, 103], [71, 22, 105], [71, 24, 106], [72, 25, 107],
+    [72, 26, 108], [72, 28, 110], [72, 29, 111], [72, 30, 112], [72, 32, 113], [72, 33, 114],
+    [72, 34, 115], [72, 35, 116], [71, 37, 117], [71, 38, 118], [71, 39, 119], [71, 40, 120],
+    [71, 42, 121], [71, 43, 122], [71, 44, 123], [70, 45, 124], [70, 47, 124], [70, 48, 125],
+    [70, 49, 126], [69, 50, 127], [69, 52, 127], [69, 53, 128], [69, 54, 129], [68, 55, 129],
+    [68, 57, 130], [67, 58, 131], [67, 59, 131], [67, 60, 132], [66, 61, 132], [66, 62, 133],
+    [66, 64, 133], [65, 65, 134], [65, 66, 134], [64, 67, 135], [64, 68, 135], [63, 69, 135],
+    [63, 71, 136], [62, 72, 136], [62, 73, 137], [61, 74, 137], [61, 75, 137], [61, 76, 137],
+    [60, 77, 138], [60, 78, 138], [59, 80, 138], [59, 81, 138], [58, 82, 139], [58, 83, 139],
+    [57, 84, 139], [57, 85, 139], [56, 86, 139], [56, 87, 140], [55, 88, 140], [55, 89, 140],
+    [54, 90, 140], [54, 91, 140], [53, 92, 140], [53, 93, 140], [52, 94, 141], [52, 95, 141],
+    [51, 96, 141], [51, 97, 141], [50, 98, 141], [50, 99, 141], [49, 100, 141], [49, 101, 141],
+    [49, 102, 141], [48, 103, 141], [48, 104, 141], [47, 105, 141], [47, 106, 141], [46, 107, 142],
+    [46, 108, 142], [46, 109, 142], [45, 110, 142], [45, 111, 142], [44, 112, 142], [44, 113, 142],
+    [44, 114, 142], [43, 115, 142], [43, 116, 142], [42, 117, 142], [42, 118, 142], [42, 119, 142],
+    [41, 120, 142], [41, 121, 142], [40, 122, 142], [40, 122, 142], [40, 123, 142], [39, 124, 142],
+    [39, 125, 142], [39, 126, 142], [38, 127, 142], [38, 128, 142], [38, 129, 142], [37, 130, 142],
+    [37, 131, 141], [36, 132, 141], [36, 133, 141], [36, 134, 141], [35, 135, 141], [35, 136, 141],
+    [35, 137, 141], [34, 137, 141], [34, 138, 141], [34, 139, 141], [33, 140, 141], [33, 141, 140],
+    [33, 142, 140], [32, 143, 140], [32, 144, 140], [32, 145, 140], [31, 146, 140], [31, 147, 139],
+    [31, 148, 139], [31, 149, 139], [31, 150, 139], [30, 151, 138], [30, 152, 138], [30, 153, 138],
+    [30, 153, 138], [30, 154, 137], [30, 155, 137], [30, 156, 137], [30, 157, 136], [30, 158, 136],
+    [30, 159, 136], [30, 160, 135], [31, 161, 135], [31, 162, 134], [31, 163, 134], [32, 164, 133],
+    [32, 165, 133], [33, 166, 133], [33, 167, 132], [34, 167, 132], [35, 168, 131], [35, 169, 130],
+    [36, 170, 130], [37, 171, 129], [38, 172, 129], [39, 173, 128], [40, 174, 127], [41, 175, 127],
+    [42, 176, 126], [43, 177, 125], [44, 177, 125], [46, 178, 124], [47, 179, 123], [48, 180, 122],
+    [50, 181, 122], [51, 182, 121], [53, 183, 120], [54, 184, 119], [56, 185, 118], [57, 185, 118],
+    [59, 186, 117], [61, 187, 116], [62, 188, 115], [64, 189, 114], [66, 190, 113], [68, 190, 112],
+    [69, 191, 111], [71, 192, 110], [73, 193, 109], [75, 194, 108], [77, 194, 107], [79, 195, 105],
+    [81, 196, 104], [83, 197, 103], [85, 198, 102], [87, 198, 101], [89, 199, 100], [91, 200, 98],
+    [94, 201, 97], [96, 201, 96], [98, 202, 95], [100, 203, 93], [103, 204, 92], [105, 204, 91],
+    [107, 205, 89], [109, 206, 88], [112, 206, 86], [114, 207, 85], [116, 208, 84], [119, 208, 82],
+    [121, 209, 81], [124, 210, 79], [126, 210, 78], [129, 211, 76], [131, 211, 75], [134, 212, 73],
+    [136, 213, 71], [139, 213, 70], [141, 214, 68], [144, 214, 67], [146, 215, 65], [149, 215, 63],
+    [151, 216, 62], [154, 216, 60], [157, 217, 58], [159, 217, 56], [162, 218, 55], [165, 218, 53],
+    [167, 219, 51], [170, 219, 50], [173, 220, 48], [175, 220, 46], [178, 221, 44], [181, 221, 43],
+    [183, 221, 41], [186, 222, 39], [189, 222, 38], [191, 223, 36], [194, 223, 34], [197, 223, 33],
+    [199, 224, 31], [202, 224, 30], [205, 224, 29], [207, 225, 28], [210, 225, 27], [212, 225, 26],
+    [215, 226, 25], [218, 226, 24], [220, 226, 24], [223, 227, 24], [225, 227, 24], [228, 227, 24],
+    [231, 228, 25], [233, 228, 25], [236, 228, 26], [238, 229, 27], [241, 229, 28], [243, 229, 30],
+    [246, 230, 31], [248, 230, 33], [250, 230, 34], [253, 231, 36],
+    [0, 0, 0],
+], dtype=np.uint8)
+_GREYS_R_LUT = np.repeat(np.array([
+    0, 1, 2, 3, 4, 5, 6, 8, 9, 10, 11, 12, 13, 15, 16, 17,
+    18, 19, 20, 22, 23, 24, 25, 26, 27, 29, 30, 31, 32, 33, 34, 35,
+    37, 38, 40, 41, 42, 44, 45, 47, 48, 49, 51, 52, 54, 55, 56, 58,
+    59, 61, 62, 64, 65, 66, 68, 69, 71, 72, 73, 75, 76, 78, 79, 80,
+    82, 83, 84, 85, 86, 87, 88, 89, 90, 91, 92, 93, 94, 95, 96, 97,
+    98, 99, 100, 101, 102, 104, 105, 106, 107, 108, 109, 110, 111, 112, 113, 114,
+    115, 116, 117, 118, 119, 120, 122, 123, 124, 125, 126, 127, 128, 129, 130, 131,
+    132, 134, 135, 136, 137, 138, 139, 140, 141, 142, 143, 145, 146, 147, 148, 149,
+    150, 151, 153, 154, 155, 156, 157, 159, 160, 161, 162, 164, 165, 166, 167, 168,
+    170, 171, 172, 173, 175, 176, 177, 178, 179, 181, 182, 183, 184, 186, 187, 188,
+    189, 190, 191, 192, 193, 193, 194, 195, 196, 197, 198, 199, 200, 200, 201, 202,
+    203, 204, 205, 206, 207, 207, 208, 209, 210, 211, 212, 213, 214, 215, 215, 216,
+    217, 218, 218, 219, 220, 221, 221, 222, 223, 224, 224, 225, 226, 226, 227, 228,
+    229, 229, 230, 231, 231, 232, 233, 234, 234, 235, 236, 237, 237, 238, 239, 239,
+    240, 240, 241, 241, 242, 242, 243, 243, 244, 244, 245, 245, 246, 246, 247, 247,
+    247, 248, 248, 249, 249, 250, 250, 251, 251, 252, 252, 253, 253, 254, 254, 255,
+    0,
+], dtype=np.uint8)[:, None], 3, axis=1)
+
+# Loaded processors and models, keyed by (model path, device, dtype) so all node instances share weights
+_MODEL_CACHE = {}
+
+def load_clipseg(model_path: str, device: torch.device, dtype: torch.dtype) -> Tuple["CLIPSegProcessor", "CLIPSegForImageSegmentation"]:
+    """Load the CLIPSeg processor and model once and keep the model on the given device and dtype in eval mode."""
+    key = (model_path, str(device), dtype)
+    if key not in _MODEL_CACHE:
+        warnings.filterwarnings("ignore", category=UserWarning, module="torch")
+        warnings.filterwarnings("ignore", category=UserWarning, module="safetensors")
+        from transformers import CLIPSegProcessor, CLIPSegForImageSegmentation
+
+        processor = CLIPSegProcessor.from_pretrained(model_path)
+        model = CLIPSegForImageSegmentation.from_pretrained(model_path).to(device, dtype=dtype).eval()
+        _MODEL_CACHE[key] = (processor, model)
+    return _MODEL_CACHE[key]
+
 def tensor_to_numpy(tensor: torch.Tensor) -> np.ndarray:
     """Convert a tensor to a numpy array and scale its values to 0-255."""
-    array = tensor.numpy().squeeze()
-    return (array * 255).astype(np.uint8)
+    # Scale in place in numpy, which is several times faster on CPU than the equivalent chain of torch ops
+    array = np.clip(tensor.squeeze().cpu().numpy(), 0, 1)
+    array *= 255
+    return array.astype(np.uint8)
+
+def colormap_indices(mask: torch.Tensor) -> torch.Tensor:
+    """Quantize a mask to colormap lookup table indices the same way matplotlib does, with invalid values mapped to the "bad" color."""
+    idx = (mask * 256).clamp(0, 255).long()
+    return idx.masked_fill_(mask.isnan(), _BAD_INDEX)
+
+def overlay_colormap(image: torch.Tensor, mask: torch.Tensor, lut: torch.Tensor, alpha: float) -> torch.Tensor:
+    """Resize a mask to the image, colorize it with a lookup table and overlay it onto the image with a given opacity (alpha), all on the image's device."""
+    height, width = image.shape[:2]
+    if image.device.type == "cpu":
+        # On CPU, OpenCV's resize, lookup and blend are several times faster than the torch ops below,
+        # which only pay off by keeping the data on a GPU
+        mask_np = mask.numpy()
+        if mask_np.shape != (height, width):
+            mask_np = cv2.resize(mask_np, (width, height), interpolation=cv2.INTER_LINEAR)
+        # Quantize like colormap_indices, np.fmax/np.fmin send invalid values to 0 and they get the "bad" color below
+        idx = np.fmax(mask_np, 0.0, dtype=np.float32)
+        np.fmin(idx, 1.0, out=idx)
+        idx *= 256
+        idx = np.minimum(idx, 255, out=idx).astype(np.uint8)
+        lut_np = lut.numpy()
+        colored_mask = cv2.LUT(cv2.merge((idx, idx, idx)), lut_np[:_BAD_INDEX].reshape(_BAD_INDEX, 1, 3))
+        invalid = np.isnan(mask_np)
+        if invalid.any():
+            # Broadcasting a single pixel over a whole image is slow in numpy, skip it for the usual black
+            bad_image = np.zeros_like(colored_mask)
+            if lut_np[_BAD_INDEX].any():
+                bad_image[:] = lut_np[_BAD_INDEX]
+            colored_mask = cv2.copyTo(bad_image, invalid.view(np.uint8), colored_mask)
+        return torch.from_numpy(cv2.addWeighted(image.numpy(), 1 - alpha, colored_mask, alpha / 255.0, 0, dtype=cv2.CV_32F))
+    if mask.shape != (height, width):
+        mask = F.interpolate(mask[None, None], size=(height, width), mode="bilinear", align_corners=False)[0, 0]
+    idx = colormap_indices(mask)
+    colored_mask = torch.index_select(lut, 0, idx.view(-1)).view(height, width, 3)
+    return image.lerp(colored_mask.to(image.dtype).div_(255.0), alpha)
+
+# Compiled numba kernels, loaded the first time the mask is post-processed on CPU (None if numba is not installed)
+_NUMBA_CACHE = {}
+
+def load_sigmoid_threshold() -> Optional[Callable[[np.ndarray, float, np.ndarray], None]]:
+    """Compile the numba kernel that applies a sigmoid to flat logits and zeros out values below the threshold in a single pass.
+
+    numba is optional and slow to import, so it is only imported here, and None is returned if it is not installed.
+    """
+    if "sigmoid_threshold" not in _NUMBA_CACHE:
+        try:
+            from numba import njit, prange
+        except ImportError:
+            _NUMBA_CACHE["sigmoid_threshold"] = None
+        else:
+            @njit(parallel=True, fastmath=True, cache=True)
+            def sigmoid_threshold(logits: np.ndarray, threshold: float, out: np.ndarray) -> None:
+                for i in prange(logits.size):
+                    v = 1.0 / (1.0 + math.exp(-logits[i]))
+                    out[i] = v if v > threshold else 0.0
+            _NUMBA_CACHE["sigmoid_threshold"] = sigmoid_threshold
+    return _NUMBA_CACHE["sigmoid_threshold"]
+
+def mirror_pad(tensor: torch.Tensor, radius: int, dim: int) -> torch.Tensor:
+    """Pad a tensor along one dimension by mirroring its borders (scipy's "reflect" mode), falling back to edge padding for pads wider than the tensor."""
+    r = min(radius, tensor.shape[dim])
+    padded = torch.cat((tensor.narrow(dim, 0, r).flip(dim), tensor, tensor.narrow(dim, tensor.shape[dim] - r, r).flip(dim)), dim=dim)
+    if r < radius:
+        pad = (radius - r, radius - r, 0, 0) if dim == -1 else (0, 0, radius - r, radius - r)
+        padded = F.pad(padded, pad, mode="replicate")
+    return padded
+
+# Largest kernel radius blurred with a direct convolution, larger kernels are applied with an FFT
+MAX_CONV_RADIUS = 32
+
+def blur_radius(sigma: float) -> int:
+    """Return the radius the Gaussian kernel is truncated at, 4 sigma like scipy.ndimage.gaussian_filter."""
+    return int(4 * sigma + 0.5)
+
+@lru_cache(maxsize=16)
+def gaussian_kernel(sigma: float, radius: int, device: torch.device, dtype: torch.dtype) -> torch.Tensor:
+    """Create a normalized 1D Gaussian kernel of the given radius, cached since the blur only takes a handful of values.
+
+    Like scipy.ndimage.gaussian_filter, the Gaussian is truncated at 4 sigma, and taps past that are zero.
+    """
+    x = torch.arange(-radius, radius + 1, device=device, dtype=dtype)
+    if sigma <= 0:
+        return (x == 0).to(dtype)
+    kernel = torch.exp(-x ** 2 / (2 * sigma ** 2)) * (x.abs() <= blur_radius(sigma))
+    return kernel / kernel.sum()
+
+def separable_blur(mask: torch.Tensor, kernel: torch.Tensor) -> torch.Tensor:
+    """Convolve a 2D mask with a 1D kernel, first along the rows, then along the columns, mirroring its borders."""
+    radius = kernel.shape[0] // 2
+    blurred = F.conv2d(mirror_pad(mask[None, None], radius, -1), kernel.view(1, 1, 1, -1))
+    blurred = F.conv2d(mirror_pad(blurred, radius, -2), kernel.view(1, 1, -1, 1))
+    return blurred[0, 0]
+
+def kernel_response(kernel: torch.Tensor, length: int) -> torch.Tensor:
+    """Compute the frequency response of a centered, symmetric 1D kernel over a signal of the given length."""
+    radius = kernel.shape[0] // 2
+    circular = torch.zeros(length, device=kernel.device, dtype=kernel.dtype)
+    circular[:radius + 1] = kernel[radius:]
+    circular[length - radius:] = kernel[:radius]
+    # The kernel is symmetric, so its response is real
+    return torch.fft.fft(circular).real
+
+def gaussian_blur(mask: torch.Tensor, sigma: float) -> torch.Tensor:
+    """Blur a 2D mask with a Gaussian kernel, keeping it on its device."""
+    if sigma <= 0:
+        return mask
+    # Truncate the kernel at 4 sigma like scipy.ndimage.gaussian_filter
+    radius = blur_radius(sigma)
+    kernel = gaussian_kernel(sigma, radius, mask.device, mask.dtype)
+    if radius > MAX_CONV_RADIUS:
+        # Large kernels are cheaper to apply as a product with the kernel's frequency response. Padding by the
+        # kernel radius keeps the circular convolution from wrapping around, so this matches the direct convolution.
+        padded = mirror_pad(mirror_pad(mask[None, None], radius, -1), radius, -2)
+        height, width = padded.shape[-2:]
+        response = kernel_response(kernel, height)[:, None] * kernel_response(kernel, width)[None, :width // 2 + 1]
+        blurred = torch.fft.irfft2(torch.fft.rfft2(padded) * response, s=(height, width))
+        return blurred[0, 0, radius:radius + mask.shape[-2], radius:radius + mask.shape[-1]]
+    return separable_blur(mask, kernel)
+
+@lru_cache(maxsize=16)
+def square_kernel(kernel_size: int) -> np.ndarray:
+    """Create a square structuring element for cv2.dilate, cached since the dilation factor only takes a handful of values."""
+    return np.ones((kernel_size, kernel_size), np.uint8)
 
-def numpy_to_tensor(array: np.ndarray) -> torch.Tensor:
-    """Convert a numpy array to a tensor and scale its values from 0-255 to 0-1."""
-    array = array.astype(np.float32) / 255.0
-    return torch.from_numpy(array)[None,]
+def dilate_mask(mask: torch.Tensor, dilation_factor: float) -> torch.Tensor:
+    """Dilate a mask using a square kernel with a given dilation factor."""
+    kernel_size = int(dilation_factor * 2) + 1
+    if mask.device.type == "cpu":
+        # On CPU, OpenCV's dilation is far faster than a stride-1 max pool
+        return torch.from_numpy(cv2.dilate(mask.numpy(), square_kernel(kernel_size), iterations=1))
+    # Dilation with a flat square kernel is a max pool with stride 1, applied separably along the rows, then the columns
+    mask_dilated = F.max_pool2d(mask[None, None], kernel_size=(1, kernel_size), stride=1, padding=(0, kernel_size // 2))
+    mask_dilated = F.max_pool2d(mask_dilated, kernel_size=(kernel_size, 1), stride=1, padding=(kernel_size // 2, 0))
+    return mask_dilated[0, 0]
 
-def apply_colormap(mask: torch.Tensor, colormap) -> np.ndarray:
-    """Apply a colormap to a tensor and convert it to a numpy array."""
-    colored_mask = colormap(mask.numpy())[:, :, :3]
-    return (colored_mask * 255).astype(np.uint8)
+def normalize_mask(mask: torch.Tensor) -> torch.Tensor:
+    """Normalize a mask to [0, 1] in place."""
+    mask_min, mask_max = mask.aminmax()
+    return mask.sub_(mask_min).div_(mask_max - mask_min)
 
-def resize_image(image: np.ndarray, dimensions: Tuple[int, int]) -> np.ndarray:
-    """Resize an image to the given dimensions using linear interpolation."""
-    return cv2.resize(image, dimensions, interpolation=cv2.INTER_LINEAR)
+def threshold_mask(logits: torch.Tensor, threshold) -> torch.Tensor:
+    """Turn CLIPSeg logits into a mask and cut off values at or below the threshold, a float or a 0-dim tensor."""
+    tensor = logits.detach().sigmoid_() # get the mask, in place since the logits are not needed afterwards
+    return tensor.masked_fill_(tensor <= threshold, 0.0)
 
-def overlay_image(background: np.ndarray, foreground: np.ndarray, alpha: float) -> np.ndarray:
-    """Overlay the foreground image onto the background with a given opacity (alpha)."""
-    return cv2.addWeighted(background, 1 - alpha, foreground, alpha, 0)
+def compute_mask(logits: torch.Tensor, threshold: torch.Tensor, kernel: torch.Tensor) -> torch.Tensor:
+    """Threshold, blur and normalize CLIPSeg logits with torch operations only, so the chain can be compiled.
 
-def dilate_mask(mask: torch.Tensor, dilation_factor: float) -> torch.Tensor:
-    """Dilate a mask using a square kernel with a given dilation factor."""
-    kernel_size = int(dilation_factor * 2) + 1
-    kernel = np.ones((kernel_size, kernel_size), np.uint8)
-    mask_dilated = cv2.dilate(mask.numpy(), kernel, iterations=1)
-    return torch.from_numpy(mask_dilated)
+    The threshold and the blur kernel are passed as tensors of fixed shape, so a compiled version only specializes
+    on the shape of the logits and not on the slider values.
+    """
+    return normalize_mask(separable_blur(threshold_mask(logits, threshold), kernel))
 
 
 
 class CLIPSeg:
 
     def __init__(self):
-        pass
+        self.device = model_management.get_torch_device()
+        self.dtype = torch.float16 if model_management.should_use_fp16(self.device) else torch.float32
+        self.processor = None
+        self.model = None
+        self.heatmap_lut = torch.from_numpy(_VIRIDIS_LUT).to(self.device)
+        self.binary_lut = torch.from_numpy(_GREYS_R_LUT).to(self.device)
+        # Fuse the mask post-processing into generated kernels where torch.compile can use Triton
+        self.compile_mask = self.device.type == "cuda" and importlib.util.find_spec("triton") is not None
+        if self.compile_mask:
+            self.compute_mask = torch.compile(compute_mask, dynamic=False)
+        else:
+            self.compute_mask = compute_mask
     
     @classmethod
     def INPUT_TYPES(s):
@@ -96,6 +323,55 @@ class CLIPSeg:
     RETURN_NAMES = ("Mask","Heatmap Mask", "BW Mask")
 
     FUNCTION = "segment_image"
+
+    def do_clipseg(self, image: np.ndarray, prompts: List[str]) -> torch.Tensor:
+        """Run CLIPSeg on an image with one or more text prompts in a single batch and return the raw logits of the segmentation masks, one per prompt."""
+        if self.model is None:
+            self.processor, self.model = load_clipseg(CLIPSEG_MODEL, self.device, self.dtype)
+
+        input_prc = self.processor(text=prompts, images=[image] * len(prompts), padding=True, return_tensors="pt")
+
+        # Move the inputs to the model's device, using pinned memory so the copy can run asynchronously
+        if self.device.type == "cuda":
+            input_prc["pixel_values"] = input_prc["pixel_values"].pin_memory()
+        input_prc = {k: v.to(self.device, non_blocking=True) for k, v in input_prc.items()}
+        input_prc["pixel_values"] = input_prc["pixel_values"].to(self.dtype)
+
+        # Predict the segemntation mask
+        with torch.no_grad():
+            outputs = self.model(**input_prc)
+
+        # see https://huggingface.co/blog/clipseg-zero-shot
+        # The logits are squeezed for a single prompt, so always return them as (prompts, height, width)
+        # in fp32, which keeps the sigmoid and normalization from overflowing in half precision
+        return outputs.logits.reshape(len(prompts), *outputs.logits.shape[-2:]).float()
+
+    def get_mask_dilated(self, logits: torch.Tensor, blur: float, threshold: float, dilation_factor: int) -> torch.Tensor:
+        """Turn the CLIPSeg logits into a thresholded, blurred, normalized and dilated mask.
+
+        Everything runs on the device of the logits.
+        """
+        # numba only speeds up the mask post-processing on CPU-only setups
+        sigmoid_threshold = load_sigmoid_threshold() if logits.device.type == "cpu" else None
+        if sigmoid_threshold is not None:
+            # Get the mask and cut off low values in one fused loop
+            tensor_thresholded = torch.empty(logits.shape, dtype=torch.float32)
+            sigmoid_threshold(logits.float().contiguous().view(-1).numpy(), threshold, tensor_thresholded.view(-1).numpy())
+            mask_normalized = normalize_mask(gaussian_blur(tensor_thresholded, blur))
+        elif blur_radius(blur) > MAX_CONV_RADIUS:
+            # The FFT blur depends on the blur value through its padding, so it stays outside the compiled chain
+            mask_normalized = normalize_mask(gaussian_blur(threshold_mask(logits, threshold), blur))
+        else:
+            # Zero-padding every kernel to the same radius gives the compiled chain a single fixed signature,
+            # the eager chain uses the truncated kernel as is
+            radius = MAX_CONV_RADIUS if self.compile_mask else blur_radius(blur)
+            kernel = gaussian_kernel(blur, radius, logits.device, logits.dtype)
+            thresh = torch.tensor(threshold, device=logits.device, dtype=logits.dtype)
+            mask_normalized = self.compute_mask(logits, thresh, kernel)
+
+        # Dilate the normalized mask, outside the compiled chain since the kernel size would be specialized on
+        return dilate_mask(mask_normalized, dilation_factor)
+
     def segment_image(self, image: torch.Tensor, text: str, blur: float, threshold: float, dilation_factor: int) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         """Create a segmentation mask from an image and a text prompt using CLIPSeg.
 
@@ -110,66 +386,26 @@ class CLIPSeg:
             Tuple[torch.Tensor, torch.Tensor, torch.Tensor]: The segmentation mask, the heatmap mask, and the binarized mask.
         """
 
-        # Convert the Tensor to a PIL image
+        # Convert the Tensor to a uint8 HWC array, which the processor accepts directly
         image_np = tensor_to_numpy(image)
-        # Create a PIL image from the numpy array
-        i = Image.fromarray(image_np, mode="RGB")
 
-        processor = CLIPSegProcessor.from_pretrained("CIDAS/clipseg-rd64-refined")
-        model = CLIPSegForImageSegmentation.from_pretrained("CIDAS/clipseg-rd64-refined")
-        
-        prompt = text
-        
-        input_prc = processor(text=prompt, images=[i], return_tensors="pt")
-        
-        # Predict the segemntation mask
-        with torch.no_grad():
-            outputs = model(**input_prc)
-        
-        # see https://huggingface.co/blog/clipseg-zero-shot
-        preds = outputs.logits.unsqueeze(1)
-        tensor = torch.sigmoid(preds[0][0]) # get the mask
-        
-        # Apply a threshold to the original tensor to cut off low values
-        thresh = threshold
-        tensor_thresholded = torch.where(tensor > thresh, tensor, torch.tensor(0, dtype=torch.float))
-
-        # Apply Gaussian blur to the thresholded tensor
-        sigma = blur
-        tensor_smoothed = gaussian_filter(tensor_thresholded.numpy(), sigma=sigma)
-        tensor_smoothed = torch.from_numpy(tensor_smoothed)
-
-        # Normalize the smoothed tensor to [0, 1]
-        mask_normalized = (tensor_smoothed - tensor_smoothed.min()) / (tensor_smoothed.max() - tensor_smoothed.min())
-
-        # Dilate the normalized mask
-        mask_dilated = dilate_mask(mask_normalized, dilation_factor)
-
-        # Convert the mask to a heatmap and a binary mask
-        heatmap = apply_colormap(mask_dilated, cm.viridis)
-        binary_mask = apply_colormap(mask_dilated, cm.Greys_r)
-
-        # Overlay the heatmap and binary mask on the original image
-        dimensions = (image_np.shape[1], image_np.shape[0])
-        heatmap_resized = resize_image(heatmap, dimensions)
-        binary_mask_resized = resize_image(binary_mask, dimensions)
+        # Predict the mask and post-process it
+        mask_dilated = self.get_mask_dilated(self.do_clipseg(image_np, [text])[0], blur, threshold, dilation_factor)
 
+        # Overlay the heatmap and binary mask on the original image on the device
+        image = image.squeeze(0).to(self.device)
+        mask = mask_dilated.to(self.device)
         alpha_heatmap, alpha_binary = 0.5, 1
-        overlay_heatmap = overlay_image(image_np, heatmap_resized, alpha_heatmap)
-        overlay_binary = overlay_image(image_np, binary_mask_resized, alpha_binary)
-
-        # Convert the numpy arrays to tensors
-        image_out_heatmap = numpy_to_tensor(overlay_heatmap)
-        image_out_binary = numpy_to_tensor(overlay_binary)
+        overlay_heatmap = overlay_colormap(image, mask, self.heatmap_lut, alpha_heatmap)
+        overlay_binary = overlay_colormap(image, mask, self.binary_lut, alpha_binary)
 
-        # Save or display the resulting binary mask
-        binary_mask_image = Image.fromarray(binary_mask_resized[..., 0])
+        # Move the overlays back to the CPU
+        image_out_heatmap = overlay_heatmap[None,].cpu()
+        image_out_binary = overlay_binary[None,].cpu()
 
-        # convert PIL image to numpy array
-        tensor_bw = binary_mask_image.convert("RGB")
-        tensor_bw = np.array(tensor_bw).astype(np.float32) / 255.0
-        tensor_bw = torch.from_numpy(tensor_bw)[None,]
-        tensor_bw = tensor_bw.squeeze(0)[..., 0]
+        # The fully opaque binary overlay is the resized binary mask itself, so one channel of it is the output mask,
+        # copied so it does not share storage with the BW Mask image
+        tensor_bw = overlay_binary[..., 0].contiguous().cpu()
 
         return tensor_bw, image_out_heatmap, image_out_binary
 
@@ -177,7 +413,9 @@ class CLIPSeg:
 
 class CombineMasks:
     def __init__(self):
-        pass
+        self.device = model_management.get_torch_device()
+        self.heatmap_lut = torch.from_numpy(_VIRIDIS_LUT).to(self.device)
+        self.binary_lut = torch.from_numpy(_GREYS_R_LUT).to(self.device)
 
     @classmethod
     def INPUT_TYPES(s):
@@ -206,24 +444,16 @@ class CombineMasks:
         combined_mask = mask_1 + mask_2 + mask_3 if mask_3 is not None else mask_1 + mask_2
 
 
-        # Convert image and masks to numpy arrays
-        image_np = tensor_to_numpy(input_image)
-        heatmap = apply_colormap(combined_mask, cm.viridis)
-        binary_mask = apply_colormap(combined_mask, cm.Greys_r)
-
-        # Resize heatmap and binary mask to match the original image dimensions
-        dimensions = (image_np.shape[1], image_np.shape[0])
-        heatmap_resized = resize_image(heatmap, dimensions)
-        binary_mask_resized = resize_image(binary_mask, dimensions)
-
-        # Overlay the heatmap and binary mask onto the original image
+        # Overlay the heatmap and binary mask onto the original image on the device
+        image = input_image.squeeze(0).to(self.device)
+        mask = combined_mask.to(self.device)
         alpha_heatmap, alpha_binary = 0.5, 1
-        overlay_heatmap = overlay_image(image_np, heatmap_resized, alpha_heatmap)
-        overlay_binary = overlay_image(image_np, binary_mask_resized, alpha_binary)
+        overlay_heatmap = overlay_colormap(image, mask, self.heatmap_lut, alpha_heatmap)
+        overlay_binary = overlay_colormap(image, mask, self.binary_lut, alpha_binary)
 
-        # Convert overlays to tensors
-        image_out_heatmap = numpy_to_tensor(overlay_heatmap)
-        image_out_binary = numpy_to_tensor(overlay_binary)
+        # Move the overlays back to the CPU
+        image_out_heatmap = overlay_heatmap[None,].cpu()
+        image_out_binary = overlay_binary[None,].cpu()
 
         return combined_mask, image_out_heatmap, image_out_binary
 